@@ -8,18 +8,31 @@ Markdown图片下载器
 
 import os
 import re
+import shutil
+import tempfile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 import time
 import logging
 from pathlib import Path
 from urllib.parse import urlparse, unquote
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
-from typing import List, Tuple, Dict
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from threading import Lock, BoundedSemaphore, Condition
+from collections import deque
+from functools import lru_cache
+from itertools import zip_longest
+from typing import List, Tuple, Dict, Deque, NamedTuple, Optional, Union, Callable
+from PIL import Image, ImageFile
 import io
 
+# 可选依赖：pyvips按需分块处理大图，内存占用更低
+try:
+    import pyvips
+except (ImportError, OSError):  # 未安装pyvips或缺少libvips
+    pyvips = None
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -31,14 +44,197 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 图片URL正则表达式
+IMG_MD_RE = re.compile(r'!\[([^\]]*)\]\(([^\)]+)\)')  # ![alt](url)
+IMG_HTML_RE = re.compile(r'<img[^>]+src=["\']([^"\'>]+)["\'][^>]*>')  # <img src="url">
+IMG_ATTR_RE = re.compile(r'(\w+)=["\']([^"\'>]+)["\']')  # img标签属性
+
+@lru_cache(maxsize=4096)
+def _url_hash(url: str) -> str:
+    """计算URL的短哈希值（12位十六进制）"""
+    return hashlib.blake2b(url.encode('utf-8'), digest_size=6).hexdigest()
+
+# 支持的图片扩展名
+_IMG_EXT = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.svg'})
+
+# 文件名非法字符替换表
+_SANITIZE_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
+def _sanitize_filename(filename: str) -> str:
+    """清理文件名，移除非法字符"""
+    # 移除或替换非法字符
+    filename = filename.translate(_SANITIZE_TABLE)
+    
+    # 限制文件名长度
+    if len(filename) > 100:
+        name, ext = os.path.splitext(filename)
+        filename = name[:95] + ext
+    
+    return filename
+
+@lru_cache(maxsize=4096)
+def _extension_for(url: str, content_type: Optional[str]) -> str:
+    """根据URL或Content-Type获取图片扩展名"""
+    # 首先尝试从URL获取扩展名
+    _, ext = os.path.splitext(unquote(urlparse(url).path))
+    ext = ext.lower()
+    
+    if ext in _IMG_EXT:
+        return ext
+    
+    # 如果URL没有扩展名，尝试从Content-Type获取
+    if content_type:
+        if 'jpeg' in content_type or 'jpg' in content_type:
+            return '.jpg'
+        elif 'png' in content_type:
+            return '.png'
+        elif 'gif' in content_type:
+            return '.gif'
+        elif 'webp' in content_type:
+            return '.webp'
+        elif 'svg' in content_type:
+            return '.svg'
+    
+    # 默认使用.jpg
+    return '.jpg'
+
+@lru_cache(maxsize=4096)
+def _filename_for(url: str, content_type: Optional[str]) -> str:
+    """生成唯一的文件名"""
+    # 使用URL的哈希值生成唯一文件名
+    url_hash = _url_hash(url)
+    
+    # 尝试从URL获取原始文件名
+    original_name = os.path.basename(unquote(urlparse(url).path))
+    
+    if original_name and '.' in original_name:
+        name, ext = os.path.splitext(original_name)
+        ext = ext.lower()
+        if ext in _IMG_EXT:
+            name = _sanitize_filename(name)[:20]  # 限制长度
+            return f"{name}_{url_hash}{ext}"
+    
+    # 如果无法从URL获取扩展名，使用Content-Type
+    return f"image_{url_hash}{_extension_for(url, content_type)}"
+
+class ImageRef(NamedTuple):
+    """Markdown中的一处图片引用，保存提取时的解析结果"""
+    url: str
+    original_text: str
+    kind: str  # 'markdown' 或 'html'
+    alt_or_attrs: Union[str, Tuple[Tuple[str, str], ...]]  # alt文本或img标签属性
+
+class DownloadJob(NamedTuple):
+    """单个图片的下载任务"""
+    md_file: Path
+    ref: ImageRef
+    local_path: Path
+
+# 超过该大小且长边超过PYVIPS_MIN_DIMENSION的图片优先使用pyvips压缩
+PYVIPS_MIN_BYTES = 4 * 1024 * 1024
+PYVIPS_MIN_DIMENSION = 2000
+
+# 进程的umask，用于设置临时文件替换后的权限（os.umask只能通过设置来读取）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# 查找Markdown文件时跳过的目录
+SKIP_DIRS = frozenset({'.git', '.venv', 'node_modules', '__pycache__'})
+
+# 不进行JPEG压缩的图片类型（矢量图、动图）
+NO_COMPRESS_TYPES = ('image/gif', 'image/svg+xml', 'image/apng')
+
+class AdaptiveConcurrency:
+    """根据实测吞吐量动态调整的并发限制"""
+    
+    def __init__(self, initial: int = 8, minimum: int = 2, maximum: int = 64,
+                 probe_interval: float = 3.0, smoothing: float = 0.3):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.probe_interval = probe_interval
+        self.smoothing = smoothing
+        self._active = 0
+        self._condition = Condition()
+        self._throughput_ewma: Optional[float] = None
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+    
+    def __enter__(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+    
+    def record(self, nbytes: int):
+        """记录已接收的字节数，每个探测周期调整一次并发数"""
+        with self._condition:
+            self._window_bytes += nbytes
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.probe_interval:
+                return
+            
+            throughput = self._window_bytes / elapsed
+            # 吞吐量提升则继续加大并发，否则回退
+            if self._throughput_ewma is None or throughput > self._throughput_ewma:
+                self.limit = min(self.limit + 2, self.maximum)
+            else:
+                self.limit = max(self.limit - 1, self.minimum)
+            
+            if self._throughput_ewma is None:
+                self._throughput_ewma = throughput
+            else:
+                self._throughput_ewma += self.smoothing * (throughput - self._throughput_ewma)
+            self._window_start = now
+            self._window_bytes = 0
+            self._condition.notify_all()
+
 class MarkdownImageDownloader:
-    def __init__(self, root_folder: str, max_workers: int = 5, max_retries: int = 3):
+    def __init__(self, root_folder: str, max_workers: Optional[int] = None, max_retries: int = 3,
+                 max_per_host: int = 10, min_interval: float = 0.05, max_size_kb: int = 500):
         self.root_folder = Path(root_folder)
-        self.max_workers = max_workers
+        # 下载为I/O密集型，线程数可远多于CPU核数
+        self.max_workers = max_workers or min(64, (os.cpu_count() or 1) * 8)
         self.max_retries = max_retries
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self.max_size_kb = max_size_kb
         self.download_lock = Lock()
         self.session = requests.Session()
         
+        # 扩大连接池，复用TCP/TLS连接；失败重试交给urllib3（指数退避，遵守Retry-After）
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers * 2,
+            pool_maxsize=self.max_workers * 4,
+            max_retries=Retry(
+                total=self.max_retries,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=['GET'],
+            ),
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        # 每个域名的并发限制，代替固定延迟
+        self._host_semaphores: Dict[str, BoundedSemaphore] = {}
+        # 每个域名最近的请求时间，用于控制请求间隔
+        self._host_buckets: Dict[str, Deque[float]] = {}
+        
+        # 全局并发数根据吞吐量自动调整，上限为线程数
+        self._concurrency = AdaptiveConcurrency(initial=min(8, self.max_workers), maximum=self.max_workers)
+        
+        # 已下载的URL及正在下载的任务，避免重复下载
+        self._url_cache: Dict[str, Path] = {}
+        self._inflight: Dict[str, Future] = {}
+        
         # 设置请求头，避免被服务器拒绝
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -50,82 +246,121 @@ class MarkdownImageDownloader:
         })
         
         # 图片URL正则表达式
-        self.image_patterns = [
-            r'!\[([^\]]*)\]\(([^\)]+)\)',  # ![alt](url)
-            r'<img[^>]+src=["\']([^"\'>]+)["\'][^>]*>',  # <img src="url">
-        ]
+        self.image_patterns = [IMG_MD_RE, IMG_HTML_RE]
         
     def find_markdown_files(self) -> List[Path]:
         """递归查找所有.md文件"""
         md_files = []
-        for md_file in self.root_folder.rglob('*.md'):
-            md_files.append(md_file)
+        stack = [str(self.root_folder)]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError as e:
+                logger.warning(f"无法读取目录: {e}")
+                continue
+            
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in SKIP_DIRS:
+                            stack.append(entry.path)
+                    elif entry.name.lower().endswith('.md') and entry.is_file(follow_symlinks=False):
+                        md_files.append(Path(entry.path))
         logger.info(f"找到 {len(md_files)} 个Markdown文件")
         return md_files
     
-    def extract_image_urls(self, content: str) -> List[Tuple[str, str]]:
+    def extract_image_urls(self, content: str) -> List[ImageRef]:
         """从Markdown内容中提取图片URL"""
         urls = []
         
         # 匹配 ![alt](url) 格式
-        pattern1 = r'!\[([^\]]*)\]\(([^\)]+)\)'
-        matches1 = re.findall(pattern1, content)
-        for alt, url in matches1:
+        for match in IMG_MD_RE.finditer(content):
+            alt, url = match.groups()
             if url.startswith(('http://', 'https://')):
-                urls.append((url, f'![{alt}]({url})'))  # (url, original_text)
+                urls.append(ImageRef(url, match.group(0), 'markdown', alt))
         
-        # 匹配 <img src="url"> 格式
-        pattern2 = r'<img[^>]+src=["\']([^"\'>]+)["\'][^>]*>'
-        matches2 = re.findall(pattern2, content)
-        for url in matches2:
+        # 匹配 <img src="url"> 格式，匹配结果即为完整的img标签
+        for match in IMG_HTML_RE.finditer(content):
+            url = match.group(1)
             if url.startswith(('http://', 'https://')):
-                # 找到完整的img标签
-                img_tag_pattern = f'<img[^>]+src=["\']' + re.escape(url) + '["\'][^>]*>'
-                img_match = re.search(img_tag_pattern, content)
-                if img_match:
-                    urls.append((url, img_match.group(0)))
+                tag = match.group(0)
+                urls.append(ImageRef(url, tag, 'html', tuple(IMG_ATTR_RE.findall(tag))))
         
         return urls
     
     def sanitize_filename(self, filename: str) -> str:
         """清理文件名，移除非法字符"""
-        # 移除或替换非法字符
-        illegal_chars = '<>:"/\\|?*'
-        for char in illegal_chars:
-            filename = filename.replace(char, '_')
-        
-        # 限制文件名长度
-        if len(filename) > 100:
-            name, ext = os.path.splitext(filename)
-            filename = name[:95] + ext
-        
-        return filename
+        return _sanitize_filename(filename)
     
     def get_image_extension(self, url: str, content_type: str = None) -> str:
         """根据URL或Content-Type获取图片扩展名"""
-        # 首先尝试从URL获取扩展名
-        parsed_url = urlparse(url)
-        path = unquote(parsed_url.path)
-        _, ext = os.path.splitext(path)
-        
-        if ext.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.svg']:
-            return ext.lower()
-        
-        # 如果URL没有扩展名，尝试从Content-Type获取
-        if content_type:
-            if 'jpeg' in content_type or 'jpg' in content_type:
-                return '.jpg'
-            elif 'png' in content_type:
-                return '.png'
-            elif 'gif' in content_type:
-                return '.gif'
-            elif 'webp' in content_type:
-                return '.webp'
-            elif 'svg' in content_type:
-                return '.svg'
-        
-        # 默认使用.jpg
-        return '.jpg'
+        return _extension_for(url, content_type)
+    
+    def _prepare_for_jpeg(self, img: Image.Image) -> Image.Image:
+        """转换为JPEG可直接编码的模式，RGB/L图片延迟到首次编码时才解码"""
+        # 带透明通道的图片合成到白色背景上
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            rgba = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            return background
+        
+        if img.mode not in ('RGB', 'L'):
+            return img.convert('RGB')
+        
+        return img
+    
+    def _encode_jpeg(self, img: Image.Image, quality: int) -> bytes:
+        """以指定质量编码JPEG（渐进式，去除EXIF/ICC元数据）"""
+        # 渐进式和optimize编码需要足够大的缓冲区，否则可能报 "Suspension not allowed"
+        ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK, img.size[0] * img.size[1])
+        
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=quality, optimize=True,
+                 progressive=True, subsampling=2, exif=b'', icc_profile=None)
+        return output.getvalue()
+    
+    def _load_vips(self, image_data: bytes) -> 'pyvips.Image':
+        """以顺序访问方式加载图片并转换为JPEG可直接编码的格式"""
+        img = pyvips.Image.new_from_buffer(image_data, '', access='sequential')
+        
+        # 带透明通道的图片合成到白色背景上
+        if img.hasalpha():
+            img = img.flatten(background=[255] * (img.bands - 1))
+        
+        return img
+    
+    def _encode_jpeg_vips(self, image_data: bytes, quality: int) -> bytes:
+        """使用pyvips以指定质量编码JPEG"""
+        # 顺序访问的图片只能读取一遍，每次编码重新加载，峰值内存保持在分块级别
+        return self._load_vips(image_data).jpegsave_buffer(
+            Q=quality, optimize_coding=True, strip=True, interlace=True
+        )
+    
+    def _compress_to_size(self, encode: Callable[[int], bytes], original_size: int, max_size_kb: int) -> bytes:
+        """二分查找满足大小要求的最高质量（20~85，步长5）"""
+        qualities = range(20, 90, 5)
+        lo, hi = 0, len(qualities) - 1
+        best = None
+        smallest = None
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            compressed_data = encode(qualities[mid])
+            
+            if len(compressed_data) <= max_size_kb * 1024:
+                best = (qualities[mid], compressed_data)
+                lo = mid + 1
+            else:
+                smallest = compressed_data
+                hi = mid - 1
+        
+        if best:
+            quality, compressed_data = best
+            logger.info(f"图片压缩成功: {original_size} -> {len(compressed_data)} bytes (质量: {quality})")
+            return compressed_data
+        
+        # 如果还是太大，返回最小质量的版本
+        return smallest
     
     def compress_image(self, image_data: bytes, max_size_kb: int = 500) -> bytes:
         """压缩图片以减少存储空间"""
@@ -134,104 +369,270 @@ class MarkdownImageDownloader:
             if len(image_data) <= max_size_kb * 1024:
                 return image_data
             
-            # 尝试压缩图片
-            img = Image.open(io.BytesIO(image_data))
-            
-            # 转换RGBA到RGB
-            if img.mode == 'RGBA':
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1])
-                img = background
-            
-            # 逐步降低质量直到满足大小要求
-            for quality in range(85, 20, -5):
-                output = io.BytesIO()
-                img.save(output, format='JPEG', quality=quality, optimize=True)
-                compressed_data = output.getvalue()
+            # Image.open只读取文件头，此时尚未解码像素
+            with Image.open(io.BytesIO(image_data)) as img:
+                # 动图转为JPEG会丢失动画，保持原样
+                if img.format == 'GIF' or getattr(img, 'is_animated', False):
+                    return image_data
                 
-                if len(compressed_data) <= max_size_kb * 1024:
-                    logger.info(f"图片压缩成功: {len(image_data)} -> {len(compressed_data)} bytes (质量: {quality})")
-                    return compressed_data
-            
-            # 如果还是太大，返回最小质量的版本
-            output = io.BytesIO()
-            img.save(output, format='JPEG', quality=20, optimize=True)
-            return output.getvalue()
+                # 超大图片使用pyvips分块处理，避免整图解码到内存
+                if (pyvips is not None and len(image_data) > PYVIPS_MIN_BYTES
+                        and max(img.size) > PYVIPS_MIN_DIMENSION):
+                    try:
+                        return self._compress_to_size(
+                            lambda quality: self._encode_jpeg_vips(image_data, quality),
+                            len(image_data), max_size_kb,
+                        )
+                    except pyvips.Error as e:
+                        logger.warning(f"pyvips压缩失败: {e}，改用Pillow")
+                
+                # 只转换一次像素格式，后续每次编码直接复用
+                img = self._prepare_for_jpeg(img)
+                return self._compress_to_size(
+                    lambda quality: self._encode_jpeg(img, quality),
+                    len(image_data), max_size_kb,
+                )
             
         except Exception as e:
             logger.warning(f"图片压缩失败: {e}，返回原始数据")
             return image_data
     
-    def download_image(self, url: str, save_path: Path, retries: int = 0) -> bool:
-        """下载单个图片"""
-        try:
-            # 如果文件已存在，跳过下载
-            if save_path.exists():
-                logger.info(f"图片已存在，跳过下载: {save_path.name}")
-                return True
-            
-            logger.info(f"正在下载: {url}")
-            
-            # 添加随机延迟避免被限制
-            time.sleep(0.5)
-            
-            response = self.session.get(url, timeout=30, stream=True)
-            response.raise_for_status()
-            
-            # 获取图片数据
-            image_data = response.content
-            
-            # 验证是否为有效图片
-            if len(image_data) < 100:  # 太小的文件可能不是有效图片
-                raise ValueError("下载的文件太小，可能不是有效图片")
-            
-            # 压缩图片（除了SVG）
-            content_type = response.headers.get('content-type', '')
-            if 'svg' not in content_type.lower():
-                image_data = self.compress_image(image_data)
-            
-            # 确保目录存在
-            save_path.parent.mkdir(parents=True, exist_ok=True)
+    def _get_host_semaphore(self, host: str) -> BoundedSemaphore:
+        """获取域名对应的并发信号量"""
+        with self.download_lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = BoundedSemaphore(self.max_per_host)
+                self._host_semaphores[host] = semaphore
+            return semaphore
+    
+    def _throttle_host(self, host: str):
+        """仅当距离同一域名的上次请求不足min_interval时才等待"""
+        with self.download_lock:
+            bucket = self._host_buckets.get(host)
+            if bucket is None:
+                bucket = deque(maxlen=self.max_per_host)
+                self._host_buckets[host] = bucket
             
-            # 保存图片
-            with open(save_path, 'wb') as f:
+            now = time.monotonic()
+            slot = max(now, bucket[-1] + self.min_interval) if bucket else now
+            bucket.append(slot)
+        
+        # 在锁外等待，不阻塞其他域名的请求
+        if slot > now:
+            time.sleep(slot - now)
+    
+    def _should_compress(self, image_data: bytes, content_type: str) -> bool:
+        """根据大小、Content-Type和文件头判断是否需要压缩"""
+        if len(image_data) <= self.max_size_kb * 1024:
+            return False
+        
+        content_type = content_type.lower()
+        if 'svg' in content_type or content_type.startswith(NO_COMPRESS_TYPES):
+            return False
+        
+        # GIF和SVG文件头
+        head = image_data[:256].lstrip()
+        if head.startswith((b'GIF87a', b'GIF89a', b'<svg', b'<?xml')):
+            return False
+        
+        return True
+    
+    def _commit_part_file(self, tmp_path: Path, save_path: Path):
+        """将临时文件替换为目标文件，权限与直接创建的文件一致"""
+        try:
+            # NamedTemporaryFile创建的文件权限为0600，改为遵循umask
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+            os.replace(tmp_path, save_path)
+        except Exception:
+            tmp_path.unlink()
+            raise
+    
+    def _write_and_compress(self, image_data: bytes, content_type: str, save_path: Path) -> int:
+        """压缩图片并写入磁盘，返回写入的字节数"""
+        # 压缩图片（除了SVG和动图）
+        if self._should_compress(image_data, content_type):
+            image_data = self.compress_image(image_data, self.max_size_kb)
+        
+        # 确保目录存在
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # 保存图片，先写入临时文件，避免中断时留下不完整的图片
+        with tempfile.NamedTemporaryFile(dir=save_path.parent, suffix='.part', delete=False) as f:
+            tmp_path = Path(f.name)
+            try:
                 f.write(image_data)
-            
-            logger.info(f"下载成功: {save_path.name} ({len(image_data)} bytes)")
-            return True
-            
-        except Exception as e:
-            logger.error(f"下载失败 {url}: {e}")
-            
-            # 重试机制
-            if retries < self.max_retries:
-                logger.info(f"重试下载 ({retries + 1}/{self.max_retries}): {url}")
-                time.sleep(2 ** retries)  # 指数退避
-                return self.download_image(url, save_path, retries + 1)
-            
+            except Exception:
+                f.close()
+                tmp_path.unlink()
+                raise
+        
+        self._commit_part_file(tmp_path, save_path)
+        
+        return len(image_data)
+    
+    def _content_length(self, response: requests.Response) -> int:
+        """解析Content-Length，缺失或格式错误时返回0"""
+        try:
+            return int(response.headers.get('content-length') or 0)
+        except ValueError:
+            return 0
+    
+    def _stream_to_file(self, response: requests.Response, save_path: Path) -> int:
+        """将响应流式写入磁盘，返回写入的字节数"""
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # 先写入临时文件，避免中断时留下不完整的图片
+        with tempfile.NamedTemporaryFile(dir=save_path.parent, suffix='.part', delete=False) as f:
+            tmp_path = Path(f.name)
+            try:
+                # iter_content将读取中断包装为requests异常，由download_image重试
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+                size = f.tell()
+            except Exception:
+                f.close()
+                tmp_path.unlink()
+                raise
+        
+        if size < 100:  # 太小的文件可能不是有效图片
+            tmp_path.unlink()
+            raise ValueError("下载的文件太小，可能不是有效图片")
+        
+        self._commit_part_file(tmp_path, save_path)
+        
+        return size
+    
+    def download_image(self, url: str, save_path: Path) -> bool:
+        """下载单个图片（建立连接和429/5xx由连接池的Retry负责重试，读取响应体失败在此重试）"""
+        body_retries = 0
+        too_small_retried = False
+        while True:
+            response_started = False
+            try:
+                # 如果文件已存在，跳过下载
+                if save_path.exists():
+                    logger.info(f"图片已存在，跳过下载: {save_path.name}")
+                    with self.download_lock:
+                        self._url_cache[url] = save_path
+                    return True
+                
+                logger.info(f"正在下载: {url}")
+                
+                # 按域名限制并发和请求间隔，避免被限制
+                host = urlparse(url).hostname or ''
+                with self._get_host_semaphore(host), self._concurrency:
+                    self._throttle_host(host)
+                    with self.session.get(url, timeout=30, stream=True) as response:
+                        response.raise_for_status()
+                        response_started = True
+                        
+                        content_type = response.headers.get('content-type', '')
+                        content_length = self._content_length(response)
+                        
+                        if (0 < content_length <= self.max_size_kb * 1024
+                                and 'content-encoding' not in response.headers):
+                            # 无需压缩的小图片直接流式写入磁盘
+                            image_data = None
+                            size = self._stream_to_file(response, save_path)
+                            self._concurrency.record(size)
+                        else:
+                            # 获取图片数据
+                            image_data = response.content
+                            self._concurrency.record(len(image_data))
+                
+                if image_data is not None:
+                    # 验证是否为有效图片
+                    if len(image_data) < 100:  # 太小的文件可能不是有效图片
+                        raise ValueError("下载的文件太小，可能不是有效图片")
+                    
+                    size = self._write_and_compress(image_data, content_type, save_path)
+                
+                logger.info(f"下载成功: {save_path.name} ({size} bytes)")
+                with self.download_lock:
+                    self._url_cache[url] = save_path
+                return True
+                
+            except ValueError as e:
+                logger.error(f"下载失败 {url}: {e}")
+                
+                # 文件过小可能是临时的错误页面，只重试一次
+                if not too_small_retried:
+                    too_small_retried = True
+                    logger.info(f"重试下载: {url}")
+                    continue
+                
+                return False
+                
+            except (requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                logger.error(f"下载失败 {url}: {e}")
+                
+                # 读取响应体时连接中断不在urllib3 Retry范围内，在此指数退避重试
+                if response_started and body_retries < self.max_retries:
+                    body_retries += 1
+                    logger.info(f"重试下载 ({body_retries}/{self.max_retries}): {url}")
+                    time.sleep(0.5 * 2 ** (body_retries - 1))
+                    continue
+                
+                return False
+                
+            except Exception as e:
+                logger.error(f"下载失败 {url}: {e}")
+                return False
+    
+    def _reuse_cached(self, url: str, local_path: Path) -> bool:
+        """复用已下载的图片，必要时复制到当前文件的images文件夹"""
+        with self.download_lock:
+            cached_path = self._url_cache.get(url)
+        
+        if cached_path is None:
             return False
+        
+        if cached_path != local_path and not local_path.exists():
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(cached_path, local_path)
+            logger.info(f"复用已下载的图片: {local_path.name}")
+        
+        return True
     
     def generate_filename(self, url: str, content_type: str = None) -> str:
         """生成唯一的文件名"""
-        # 使用URL的哈希值生成唯一文件名
-        url_hash = hashlib.md5(url.encode()).hexdigest()[:12]
+        return _filename_for(url, content_type)
+    
+    def build_replacement_text(self, ref: ImageRef, local_path: str) -> str:
+        """根据提取时的解析结果生成指向本地路径的新文本"""
+        if ref.kind == 'markdown':
+            # 处理 ![alt](url) 格式
+            return f"![{ref.alt_or_attrs}]({local_path})"
         
-        # 尝试从URL获取原始文件名
-        parsed_url = urlparse(url)
-        original_name = os.path.basename(unquote(parsed_url.path))
+        # 处理 <img> 标签格式，保留img标签的其他属性
+        attrs_dict = dict(ref.alt_or_attrs)
         
-        if original_name and '.' in original_name:
-            name, ext = os.path.splitext(original_name)
-            name = self.sanitize_filename(name)[:20]  # 限制长度
-            if ext.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.svg']:
-                return f"{name}_{url_hash}{ext.lower()}"
+        # 构建新的img标签
+        new_attrs = [f'src="{local_path}"']
+        for attr, value in attrs_dict.items():
+            if attr.lower() != 'src':
+                new_attrs.append(f'{attr}="{value}"')
         
-        # 如果无法从URL获取扩展名，使用Content-Type
-        ext = self.get_image_extension(url, content_type)
-        return f"image_{url_hash}{ext}"
+        return f'<img {" ".join(new_attrs)}>'
     
-    def process_markdown_file(self, md_file: Path) -> Dict[str, str]:
-        """处理单个Markdown文件"""
+    def replace_image_links(self, content: str, url_replacements: Dict[ImageRef, str]) -> str:
+        """一次扫描替换所有图片链接"""
+        new_texts = {
+            ref.original_text: self.build_replacement_text(ref, local_path)
+            for ref, local_path in url_replacements.items()
+        }
+        
+        # 较长的文本优先匹配，避免被其前缀抢先匹配
+        pattern = re.compile('|'.join(
+            re.escape(text) for text in sorted(new_texts, key=len, reverse=True)
+        ))
+        return pattern.sub(lambda m: new_texts[m.group(0)], content)
+    
+    def plan(self, md_file: Path) -> List[DownloadJob]:
+        """扫描单个Markdown文件，生成下载任务"""
         logger.info(f"处理文件: {md_file}")
         
         try:
@@ -244,7 +645,7 @@ class MarkdownImageDownloader:
             
             if not image_urls:
                 logger.info(f"文件中没有找到在线图片: {md_file.name}")
-                return {}
+                return []
             
             logger.info(f"找到 {len(image_urls)} 个图片链接")
             
@@ -252,75 +653,115 @@ class MarkdownImageDownloader:
             images_folder = md_file.parent / 'images'
             images_folder.mkdir(exist_ok=True)
             
-            # 下载图片并记录替换映射
-            url_replacements = {}
+            # 生成本地文件名
+            return [
+                DownloadJob(md_file, ref, images_folder / self.generate_filename(ref.url))
+                for ref in image_urls
+            ]
             
-            # 使用线程池并行下载
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                future_to_url = {}
-                
-                for url, original_text in image_urls:
-                    # 生成本地文件名
-                    filename = self.generate_filename(url)
-                    local_path = images_folder / filename
-                    
-                    # 提交下载任务
-                    future = executor.submit(self.download_image, url, local_path)
-                    future_to_url[future] = (url, original_text, local_path)
+        except Exception as e:
+            logger.error(f"处理文件失败 {md_file}: {e}")
+            return []
+    
+    def _interleave_by_host(self, jobs: List[DownloadJob]) -> List[DownloadJob]:
+        """按域名轮流排列任务，避免线程集中阻塞在同一域名的并发限制上"""
+        groups: Dict[str, List[DownloadJob]] = {}
+        for job in jobs:
+            groups.setdefault(urlparse(job.ref.url).hostname or '', []).append(job)
+        
+        return [job for batch in zip_longest(*groups.values()) for job in batch if job is not None]
+    
+    def download_jobs(self, jobs: List[DownloadJob], executor: ThreadPoolExecutor) -> Dict[Path, Dict[ImageRef, str]]:
+        """并行执行下载任务，返回每个文件的替换映射"""
+        results: Dict[Path, Dict[ImageRef, str]] = {}
+        future_to_jobs: Dict[Future, List[DownloadJob]] = {}
+        
+        # 各域名的任务轮流提交，所有域名同时开始下载
+        jobs = self._interleave_by_host(jobs)
+        
+        for job in jobs:
+            url_replacements = results.setdefault(job.md_file, {})
+            
+            # 已下载或正在下载的URL不再重复提交
+            with self.download_lock:
+                cached = job.ref.url in self._url_cache
+                future = self._inflight.get(job.ref.url)
+                if not cached and future is None:
+                    future = executor.submit(self.download_image, job.ref.url, job.local_path)
+                    self._inflight[job.ref.url] = future
+            
+            if cached:
+                try:
+                    if self._reuse_cached(job.ref.url, job.local_path):
+                        url_replacements[job.ref] = f"images/{job.local_path.name}"
+                except Exception as e:
+                    logger.error(f"复用图片失败 {job.ref.url}: {e}")
+                continue
+            
+            future_to_jobs.setdefault(future, []).append(job)
+        
+        # 收集下载结果
+        for future in as_completed(future_to_jobs):
+            for job in future_to_jobs[future]:
+                with self.download_lock:
+                    self._inflight.pop(job.ref.url, None)
                 
-                # 收集下载结果
-                for future in as_completed(future_to_url):
-                    url, original_text, local_path = future_to_url[future]
-                    
-                    try:
-                        success = future.result()
-                        if success:
-                            # 生成相对路径
-                            relative_path = f"images/{local_path.name}"
-                            url_replacements[original_text] = relative_path
-                        else:
-                            logger.error(f"下载失败，保持原链接: {url}")
-                    except Exception as e:
-                        logger.error(f"下载任务异常: {e}")
+                try:
+                    success = future.result() and self._reuse_cached(job.ref.url, job.local_path)
+                    if success:
+                        # 生成相对路径
+                        relative_path = f"images/{job.local_path.name}"
+                        results[job.md_file][job.ref] = relative_path
+                    else:
+                        logger.error(f"下载失败，保持原链接: {job.ref.url}")
+                except Exception as e:
+                    logger.error(f"下载任务异常: {e}")
+        
+        return results
+    
+    def apply(self, md_file: Path, url_replacements: Dict[ImageRef, str]) -> Dict[str, str]:
+        """将下载结果写回Markdown文件，返回原始文本到本地路径的映射"""
+        if not url_replacements:
+            return {}
+        
+        try:
+            with open(md_file, 'r', encoding='utf-8') as f:
+                content = f.read()
             
             # 更新Markdown文件内容
-            if url_replacements:
-                updated_content = content
-                for original_text, local_path in url_replacements.items():
-                    if original_text.startswith('!['):
-                        # 处理 ![alt](url) 格式
-                        alt_match = re.match(r'!\[([^\]]*)\]\([^\)]+\)', original_text)
-                        if alt_match:
-                            alt_text = alt_match.group(1)
-                            new_text = f"![{alt_text}]({local_path})"
-                            updated_content = updated_content.replace(original_text, new_text)
-                    else:
-                        # 处理 <img> 标签格式
-                        # 提取img标签的其他属性
-                        img_attrs = re.findall(r'(\w+)=["\']([^"\'>]+)["\']', original_text)
-                        attrs_dict = dict(img_attrs)
-                        
-                        # 构建新的img标签
-                        new_attrs = [f'src="{local_path}"']
-                        for attr, value in attrs_dict.items():
-                            if attr.lower() != 'src':
-                                new_attrs.append(f'{attr}="{value}"')
-                        
-                        new_text = f'<img {" ".join(new_attrs)}>'
-                        updated_content = updated_content.replace(original_text, new_text)
-                
-                # 保存更新后的文件
-                with open(md_file, 'w', encoding='utf-8') as f:
-                    f.write(updated_content)
-                
-                logger.info(f"文件更新完成: {md_file.name} (替换了 {len(url_replacements)} 个图片链接)")
+            updated_content = self.replace_image_links(content, url_replacements)
+            
+            # 先写入临时文件再原子替换，中断时不会损坏原文件
+            tmp_file = md_file.with_suffix(md_file.suffix + '.tmp')
+            try:
+                tmp_file.write_text(updated_content, encoding='utf-8')
+                shutil.copymode(md_file, tmp_file)  # 保留原文件的权限位
+                os.replace(tmp_file, md_file)
+            except Exception:
+                # 写入失败（如文件被编辑器占用）时清理临时文件
+                if tmp_file.exists():
+                    tmp_file.unlink()
+                raise
             
-            return url_replacements
+            logger.info(f"文件更新完成: {md_file.name} (替换了 {len(url_replacements)} 个图片链接)")
+            return {ref.original_text: local_path for ref, local_path in url_replacements.items()}
             
         except Exception as e:
             logger.error(f"处理文件失败 {md_file}: {e}")
             return {}
     
+    def process_markdown_file(self, md_file: Path) -> Dict[str, str]:
+        """处理单个Markdown文件"""
+        jobs = self.plan(md_file)
+        if not jobs:
+            return {}
+        
+        # 使用线程池并行下载
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = self.download_jobs(jobs, executor)
+        
+        return self.apply(md_file, results.get(md_file, {}))
+    
     def run(self):
         """运行主程序"""
         logger.info(f"开始处理文件夹: {self.root_folder}")
@@ -337,10 +778,21 @@ class MarkdownImageDownloader:
         processed_files = 0
         total_images = 0
         
-        # 处理每个文件
+        # 先收集所有文件的下载任务
+        jobs: List[DownloadJob] = []
+        for md_file in md_files:
+            jobs.extend(self.plan(md_file))
+        
+        logger.info(f"共 {len(jobs)} 个图片链接待下载")
+        
+        # 所有文件的下载共用一个线程池
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = self.download_jobs(jobs, executor)
+        
+        # 逐个文件更新链接
         for md_file in md_files:
             try:
-                replacements = self.process_markdown_file(md_file)
+                replacements = self.apply(md_file, results.get(md_file, {}))
                 processed_files += 1
                 total_images += len(replacements)
                 
@@ -361,7 +813,7 @@ def main():
     # 创建下载器实例
     downloader = MarkdownImageDownloader(
         root_folder=root_folder,
-        max_workers=10,  # 并行下载线程数
+        max_workers=None,  # 并行下载线程数，默认 min(64, CPU核数*8)
         max_retries=3   # 最大重试次数
     )
     